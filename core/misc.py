@@ -15,8 +15,12 @@ visvis modules.
 
 """
 
+import atexit
+import functools
 import os
+import re
 import sys
+import threading
 import zipfile
 
 import numpy as np
@@ -66,6 +70,12 @@ def splitPathInZip(path):
 # To store openGl info
 _glInfo = [None]*4
 
+# To store the openGl version, parsed into a tuple of ints
+_glVersionTuple = [None]
+
+# To store the set of openGl extensions
+_glExtensionSet = [None]
+
 
 def ensureString(s):
     if isinstance(s, str):
@@ -91,34 +101,66 @@ def getOpenGlInfo():
         _glInfo[1] = ensureString(gl.glGetString(gl.GL_VENDOR))
         _glInfo[2] = ensureString(gl.glGetString(gl.GL_RENDERER))
         _glInfo[3] = ensureString(gl.glGetString(gl.GL_EXTENSIONS))
+        _glExtensionSet[0] = frozenset(_glInfo[3].split())
+        m = re.search(r'(\d+)\.(\d+)', _glInfo[0])
+        if m:
+            _glVersionTuple[0] = int(m.group(1)), int(m.group(2))
     return tuple(_glInfo)
 
+def hasGlExtension(extension):
+    """ hasGlExtension(extension)
+
+    Returns whether the OpenGl implementation on this system has the
+    given extension. The extension string is fetched and split only
+    once; each check is then a set lookup.
+
+    """
+    extensions = _glExtensionSet[0]
+    if extensions is None:
+        getOpenGlInfo()
+        extensions = _glExtensionSet[0]
+        if extensions is None:
+            return False # OpenGl context not set
+    return extension in extensions
+
 _glLimitations = {}
+_glCapable = {}
 def getOpenGlCapable(version, what=None):
     """ getOpenGlCapable(version, what)
-    
+
     Returns True if the OpenGl version on this system is equal or higher
     than the one specified and False otherwise.
-    
+
     If False, will display a message to inform the user, but only the first
     time that this limitation occurs (identified by the second argument).
-    
+
     """
-    
-    # obtain version of system
-    curVersion = _glInfo[0]
+
+    # answer known? (this is called from the draw loop)
+    try:
+        return _glCapable[version, what]
+    except KeyError:
+        pass
+
+    # obtain parsed version of system
+    curVersion = _glVersionTuple[0]
     if not curVersion:
-        curVersion, dum1, dum2, dum3 = getOpenGlInfo()
+        getOpenGlInfo()
+        curVersion = _glVersionTuple[0]
         if not curVersion:
             return False # OpenGl context not set, better safe than sory
-    
-    # make sure version is a string
-    if isinstance(version, (int,float)):
-        version = str(version)
-    
+
+    # parse the required version into a tuple of ints, so that for
+    # instance '10.0' compares higher than '2.0'
+    if isinstance(version, tuple):
+        neededVersion = version
+    else:
+        m = re.search(r'(\d+)\.?(\d*)', str(version))
+        neededVersion = int(m.group(1)), int(m.group(2) or 0)
+
     # test
-    if curVersion >= version :
-        return True
+    if curVersion >= neededVersion:
+        result = True
     else:
         # show message?
         if what and (what not in _glLimitations):
@@ -127,7 +169,11 @@ def getOpenGlCapable(version, what=None):
             tmp += "to support " + what + ". "
             tmp += "Try updating your drivers or buy a new video card."
             print(tmp)
-        return False
+        result = False
+
+    # remember the answer
+    _glCapable[version, what] = result
+    return result
 
 
 ## Decorators
@@ -163,22 +209,22 @@ def Property(function):
     
     # Define known keys
     known_keys = 'fget', 'fset', 'fdel', 'doc'
-    
+
     # Get elements for defining the property. This should return a dict
     func_locals = function()
     if not isinstance(func_locals, dict):
         raise RuntimeError('Property function should "return locals()".')
-    
+
     # Create dict with kwargs for property(). Init doc with docstring.
     D = {'doc': function.__doc__}
-    
+
     # Copy known keys. Check if there are invalid keys
     for key in list(func_locals.keys()):
         if key in known_keys:
             D[key] = func_locals[key]
         else:
             raise RuntimeError('Invalid Property element: %s' % key)
-    
+
     # Done
     return property(**D)
 
@@ -195,22 +241,22 @@ def PropWithDraw(function):
     
     # Define known keys
     known_keys = 'fget', 'fset', 'fdel', 'doc'
-    
+
     # Get elements for defining the property. This should return a dict
     func_locals = function()
     if not isinstance(func_locals, dict):
         raise RuntimeError('Property function should "return locals()".')
-    
+
     # Create dict with kwargs for property(). Init doc with docstring.
     D = {'doc': function.__doc__}
-    
+
     # Copy known keys. Check if there are invalid keys
     for key in list(func_locals.keys()):
         if key in known_keys:
             D[key] = func_locals[key]
         else:
             raise RuntimeError('Invalid Property element: %s' % key)
-    
+
     # Replace fset
     fset = D.get('fset', None)
     def fsetWithDraw(self, *args):
@@ -235,8 +281,9 @@ def DrawAfter(function):
     """
     def newFunc(self, *args, **kwargs):
         retval = function(self, *args, **kwargs)
-        if hasattr(self, 'Draw'):
-            self.Draw()
+        draw = getattr(self, 'Draw', None)
+        if draw is not None:
+            draw()
         return retval
     newFunc.__doc__ = function.__doc__
     return newFunc
@@ -246,36 +293,38 @@ def PropertyForSettings(function):
     """ PropertyForSettings(function)
     
     A property decorator that also supplies the function name to the
-    fget and fset function. The fset method also calls _Save()
+    fget and fset function. The fset method also schedules a (deferred)
+    save of the settings.
     
     """
     
     # Define known keys
     known_keys = 'fget', 'fset', 'fdel', 'doc'
-    
+
     # Get elements for defining the property. This should return a dict
     func_locals = function()
     if not isinstance(func_locals, dict):
-        raise RuntimeError('From visvis version 1.6, Property function should "return locals()".')
-    
+        raise RuntimeError('Property function should "return locals()".')
+
     # Create dict with kwargs for property(). Init doc with docstring.
     D = {'doc': function.__doc__}
-    
+
     # Copy known keys. Check if there are invalid keys
     for key in list(func_locals.keys()):
         if key in known_keys:
             D[key] = func_locals[key]
         else:
             raise RuntimeError('Invalid Property element: %s' % key)
-    
-    # Replace fset and fget
+
+    # Replace fset and fget. The key and original functions are bound as
+    # default arguments, so calling the property means only local lookups.
     fset = D.get('fset', None)
     fget = D.get('fget', None)
-    def fsetWithKey(self, *args):
-        fset(self, function.__name__, *args)
-        self._Save()
-    def fgetWithKey(self, *args):
-        return fget(self, function.__name__)
+    def fsetWithKey(self, value, fset=fset, key=function.__name__):
+        fset(self, key, value)
+        self._ScheduleSave()
+    def fgetWithKey(self, fget=fget, key=function.__name__):
+        return fget(self, key)
     if fset:
         D['fset'] = fsetWithKey
     if fget:
@@ -338,8 +387,9 @@ class Range(object):
     
     def _Check(self):
         """ Flip min and max if order is wrong. """
-        if self._min > self._max:
-            self._max, self._min = self._min, self._max
+        lo, hi = self._min, self._max
+        self._min = min(lo, hi)
+        self._max = max(lo, hi)
     
     def Copy(self):
         return Range(self.min, self.max)
@@ -349,6 +399,11 @@ class Range(object):
 
 
 ## Transform classes for wobjects
+
+
+# Hoisted constant to convert radians to degrees with a single multiply
+_RAD2DEG = 180.0 / np.pi
+
     
     
 class Transform_Base(object):
@@ -391,7 +446,7 @@ class Transform_Rotate(Transform_Base):
     """
     def __init__(self, angle=0.0, ax=0, ay=0, az=1, angleInRadians=None):
         if angleInRadians is not None:
-            angle = angleInRadians * 180 / np.pi
+            angle = angleInRadians * _RAD2DEG
         self.angle = angle
         self.ax = ax
         self.ay = ay
@@ -410,35 +465,52 @@ colorDict['cyan']   = colorDict['c'] = (0,1,1)
 colorDict['yellow'] = colorDict['y'] = (1,1,0)
 colorDict['magenta']= colorDict['m'] = (1,0,1)
 
+def _colorFromString(value, descr):
+    try:
+        return colorDict[value]
+    except KeyError:
+        raise ValueError(
+            "Error in %s: string color must be one of 'rgbycmkw' !" % descr)
+
+def _colorFromSequence(value, descr):
+    if len(value) != 3:
+        raise ValueError("Error in %s: tuple color must be length 3!" % descr)
+    return tuple(value)
+
+# Dispatch on the exact type; getColor is called on every plot command
+_colorHandlers = {str: _colorFromString,
+                  tuple: _colorFromSequence, list: _colorFromSequence}
+if V2:
+    _colorHandlers[unicode] = _colorFromString  # noqa
+
 def getColor(value, descr='getColor'):
     """ getColor(value, descr='getColor')
-    
+
     Make sure a value is a color. If a character is given, returns the color
     as a tuple.
-    
+
     """
-    tmp = ""
+    # Fast path: a correct color tuple can be returned as-is, without
+    # rebuilding it
+    if type(value) is tuple and len(value) == 3:
+        return value
     if not value:
-        value = None
-    elif isinstance(value, basestring):
-        if value not in colorDict:
-            tmp = "string color must be one of 'rgbycmkw' !"
-        else:
-            value = colorDict[value]
+        return None
+    handler = _colorHandlers.get(type(value))
+    if handler is not None:
+        return handler(value, descr)
+    # Fall back to isinstance checks for subclasses of str/tuple/list
+    if isinstance(value, basestring):
+        return _colorFromString(value, descr)
     elif isinstance(value, (list, tuple)):
-        if len(value) != 3:
-            tmp = "tuple color must be length 3!"
-        value = tuple(value)
-    else:
-        tmp = "color must be a three element tuple or a character!"
-    # error or ok?
-    if tmp:
-        raise ValueError("Error in %s: %s" % (descr, tmp) )
-    return value
+        return _colorFromSequence(value, descr)
+    raise ValueError("Error in %s: color must be a three element tuple "
+                     "or a character!" % descr)
 
 
 ## More functions ...
 
+@functools.lru_cache(maxsize=1)
 def isFrozen():
     """ isFrozen
     
@@ -451,6 +523,7 @@ def isFrozen():
 
 # todo: cx_Freeze and friends should provide a mechanism to store
 # resources automatically ...
+@functools.lru_cache(maxsize=1)
 def getResourceDir():
     """ getResourceDir()
     
@@ -468,6 +541,7 @@ def getResourceDir():
 
 # From pyzolib/paths.py
 import os, sys  # noqa
+@functools.lru_cache()
 def appdata_dir(appname=None, roaming=False, macAsLinux=False):
     """ appdata_dir(appname=None, roaming=False,  macAsLinux=False)
     Get the path to the application directory, where applications are allowed
@@ -515,12 +589,21 @@ def appdata_dir(appname=None, roaming=False, macAsLinux=False):
             appname = '.' + appname.lstrip('.') # Make it a hidden directory
         path = os.path.join(path, appname)
         if not os.path.isdir(path):
-            os.mkdir(path)
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                pass  # Created in the meantime; the cached result is fine
     
     # Done
     return path
 
 
+# Allowed values for the settings validated below
+_BACKENDS = frozenset(['pyside', 'qt4', 'pyqt4', 'wx', 'gtk', 'fltk', 'foo'])
+_FONTS = frozenset(['mono', 'sans', 'serif', 'humor'])
+_VOLSHOW = frozenset([2, 3])
+
+
 class Settings(object):
     """ Global settings object.
     
@@ -554,8 +637,14 @@ class Settings(object):
                 continue
             self._s[key] = getattr(self, key)
         
+        # No save is pending yet
+        self._saveTimer = None
+        
         # Save now so the config file contains all settings
         self._Save()
+        
+        # Make sure a pending save is not lost when Python exits
+        atexit.register(self._FlushSave)
     
     def _Save(self):
         try:
@@ -563,6 +652,24 @@ class Settings(object):
         except IOError:
             pass # Maybe an installed frozen application (no write-rights)
     
+    def _ScheduleSave(self):
+        # Coalesce a burst of property writes into a single disk write,
+        # by (re)starting a timer that does the actual save
+        timer = self._saveTimer
+        if timer is not None:
+            timer.cancel()
+        self._saveTimer = timer = threading.Timer(0.5, self._FlushSave)
+        timer.daemon = True
+        timer.start()
+    
+    def _FlushSave(self):
+        # Save now, if (and only if) a save is pending
+        timer = self._saveTimer
+        self._saveTimer = None
+        if timer is not None:
+            timer.cancel()
+            self._Save()
+    
     @PropertyForSettings
     def preferredBackend():
         """ The preferred backend GUI toolkit to use
@@ -580,7 +687,7 @@ class Settings(object):
         def fset(self, key, value):
             # Note that 'qt4' in valid for backward compatibility
             value = value.lower()
-            if value in ['pyside', 'qt4', 'pyqt4', 'wx', 'gtk', 'fltk', 'foo']:
+            if value in _BACKENDS:
                 self._s[key] = value
             else:
                 raise ValueError('Invalid backend specified.')
@@ -649,7 +756,7 @@ class Settings(object):
             else:
                 return 3  # Default value
         def fset(self, key, value):
-            if value not in [2,3]:
+            if value not in _VOLSHOW:
                 raise ValueError('volshowPreference must be 2 or 3.')
             self._s[key] = int(value)
         return locals()
@@ -666,7 +773,7 @@ class Settings(object):
                 return 'sans'  # Default value
         def fset(self, key, value):
             value = value.lower()
-            if value not in ['mono', 'sans', 'serif', 'humor']:
+            if value not in _FONTS:
                 raise ValueError("defaultFontName must be 'mono', 'sans', 'serif' or 'humor'.")
             self._s[key] = value
         return locals()
@@ -6,57 +6,126 @@
 
 import numpy as np
 import visvis as vv
-from visvis.utils.pypoints import Point, Pointset
+from visvis.utils.pypoints import Pointset
 from visvis.wobjects.polygonalModeling import BaseMesh
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 def getSpanVectors(normal, c, d):
     """ getSpanVectors(normal, prevA, prevB) -> (a,b)
-    
+
     Given a normal, return two orthogonal vectors which are both orthogonal
     to the normal. The vectors are calculated so they match as much as possible
-    the previous vectors.
-    
+    the previous vectors. All vectors are 3-element numpy arrays.
+
     """
-    
+
     # Calculate a from previous b
-    a1 = d.cross(normal)
-    
-    if a1.norm() < 0.001:
+    a1 = np.cross(d, normal)
+
+    if (a1*a1).sum()**0.5 < 0.001:
         # The normal and  d point in same or reverse direction
         # -> Calculate b from previous a
-        b1 = c.cross(normal)
-        a1 = b1.cross(normal)
-    
+        b1 = np.cross(c, normal)
+        a1 = np.cross(b1, normal)
+
     # Consider the opposite direction
     a2 = -1 * a1
-    if c.distance(a1) > c.distance(a2):
+    if ((c-a1)**2).sum() > ((c-a2)**2).sum():
         a1 = a2
-    
+
     # Ok, calculate b
-    b1 = a1.cross(normal)
-        
+    b1 = np.cross(a1, normal)
+
 #     # Consider the opposite (don't: this would make backfacing faces)
 #     b2 = -1 * b1
 #     if d.distance(b1) > d.distance(b2):
 #         b1 = b2
 
     # Done
-    return a1.normalize(), b1.normalize()
+    return a1 / (a1*a1).sum()**0.5, b1 / (b1*b1).sum()**0.5
 
 
-def getCircle(angles_cos, angles_sin, a, b):
-    """ getCircle(angles_cos, angles_sin, a, b) -> circle_cords
-    
+def _propagateSpans(normals, a, b, A, B):
+    # The sequential span-vector propagation, written with scalar triples
+    # (no numpy calls inside the loop) so that numba can compile it to
+    # native code when available; see below.
+    ax, ay, az = a[0], a[1], a[2]
+    bx, by, bz = b[0], b[1], b[2]
+    for i in range(normals.shape[0]):
+        nx, ny, nz = normals[i,0], normals[i,1], normals[i,2]
+        # a1 = b cross normal
+        a1x = by*nz - bz*ny
+        a1y = bz*nx - bx*nz
+        a1z = bx*ny - by*nx
+        if (a1x*a1x + a1y*a1y + a1z*a1z) ** 0.5 < 0.001:
+            # The normal and b point in same or reverse direction
+            # -> b1 = a cross normal; a1 = b1 cross normal
+            b1x = ay*nz - az*ny
+            b1y = az*nx - ax*nz
+            b1z = ax*ny - ay*nx
+            a1x = b1y*nz - b1z*ny
+            a1y = b1z*nx - b1x*nz
+            a1z = b1x*ny - b1y*nx
+        # Consider the opposite direction
+        d1 = (ax-a1x)**2 + (ay-a1y)**2 + (az-a1z)**2
+        d2 = (ax+a1x)**2 + (ay+a1y)**2 + (az+a1z)**2
+        if d1 > d2:
+            a1x, a1y, a1z = -a1x, -a1y, -a1z
+        # b1 = a1 cross normal
+        b1x = a1y*nz - a1z*ny
+        b1y = a1z*nx - a1x*nz
+        b1z = a1x*ny - a1y*nx
+        # Normalize and store
+        an = (a1x*a1x + a1y*a1y + a1z*a1z) ** 0.5
+        bn = (b1x*b1x + b1y*b1y + b1z*b1z) ** 0.5
+        ax, ay, az = a1x/an, a1y/an, a1z/an
+        bx, by, bz = b1x/bn, b1y/bn, b1z/bn
+        A[i,0], A[i,1], A[i,2] = ax, ay, az
+        B[i,0], B[i,1], B[i,2] = bx, by, bz
+
+if numba is not None:
+    _propagateSpans = numba.njit(cache=True)(_propagateSpans)
+
+
+def getSpanVectorsBatch(normals, a, b):
+    """ getSpanVectorsBatch(normals, a, b) -> (A, B)
+
+    Calculate the span vectors for a whole sequence of normals (an Mx3
+    numpy array) at once, given the initial a and b vectors. Because each
+    pair of span vectors depends on the previous pair, this is a short
+    sequential pass, but it stores directly into preallocated arrays and
+    is compiled with numba when that is available.
+
+    """
+    M = normals.shape[0]
+    A = np.empty((M,3), dtype=np.float32)
+    B = np.empty((M,3), dtype=np.float32)
+    _propagateSpans(normals, a, b, A, B)
+    return A, B
+
+
+def _normalizeRows(X):
+    # Normalize the vectors along the last axis of X, in place; einsum
+    # gives the squared norms without an intermediate square array
+    norms = np.sqrt(np.einsum('...i,...i->...', X, X))
+    np.divide(X, norms[..., None], out=X)
+    return X
+
+
+def getCircle(angles_cs, a, b):
+    """ getCircle(angles_cs, a, b) -> circle_cords
+
     Creates a circle of points around the origin,
     the circle is spanned by the vectors a and b.
-    
+    angles_cs is a vertex_num x 2 array holding the cosines and sines of
+    the angles, so the circle is a single matrix product.
+
     """
-    X = np.empty((len(angles_cos),3),dtype=np.float32)
-    X[:,0] = angles_cos * a.x + angles_sin * b.x
-    X[:,1] = angles_cos * a.y + angles_sin * b.y
-    X[:,2] = angles_cos * a.z + angles_sin * b.z
-    
-    return Pointset(X)
+    return angles_cs.dot(np.vstack((a, b)))
 
 
 def lineToMesh(pp, radius, vertex_num, values=None):
@@ -99,26 +168,59 @@ def lineToMesh(pp, radius, vertex_num, values=None):
     angles = np.arange(0, pi*2-0.0001, pi*2/vertex_num)
     angle_cos = np.cos(angles)
     angle_sin = np.sin(angles)
+    angles_cs = np.stack([angle_cos, angle_sin], axis=1).astype(np.float32)
     vertex_num2 = len(angles) # just to be sure
     
-    # calculate distance between two line pieces (for smooth cylinders)
-    dists = pp[1:].distance(pp[:-1])
-    bufdist = min( radius.max(), dists.min()/2.2)
-    
+    # get the points as a plain Nx3 array so the calculations below are
+    # single numpy operations rather than per-point Python loops
+    P = np.asarray(pp.data, dtype=np.float32)
+
+    # calculate distance between two line pieces (for smooth cylinders);
+    # einsum gives the squared norms without an intermediate square array
+    seg = P[1:] - P[:-1]
+    dists = np.sqrt(np.einsum('ij,ij->i', seg, seg))
+    bufdist = float(min( radius.max(), dists.min()/2.2))
+
     # check if line is closed
-    lclosed = np.all(pp[0]==pp[-1])
-    
+    lclosed = np.all(P[0]==P[-1])
+
     # calculate normal vectors on each line point
-    normals = pp[:-1].subtract( pp[1:] ).copy()
+    normals = np.empty((len(P),3), dtype=np.float32)
+    normals[:-1] = seg / dists[:,None]
     if lclosed:
-        normals.append( pp[0]-pp[1] )
+        normals[-1] = normals[0]
     else:
-        normals.append( pp[-2]-pp[-1] )
-    normals = -1 * normals.normalize()
-    
-    # create list to store vertices
-    vertices = Pointset(3)
-    surfaceNormals = Pointset(3)
+        normals[-1] = normals[-2]
+
+    # calculate the in-between normals used to connect the line pieces
+    mids = _normalizeRows(normals[:-1] + normals[1:])
+
+    # Calculate the span vectors for all circles up front. The sequence
+    # matches the order in which the circles are created below: the first
+    # circle, then per line piece the main circle and the in-between circle.
+    if lclosed:
+        spanNormals = np.empty((2*len(P),3), dtype=np.float32)
+        spanNormals[1:-1:2] = normals[:-1]
+        spanNormals[2:-1:2] = mids
+        spanNormals[-1] = normals[-1]
+    else:
+        spanNormals = np.empty((2*len(P)-2,3), dtype=np.float32)
+        spanNormals[1::2] = normals[:-1]
+        spanNormals[2::2] = mids[:-1]
+    spanNormals[0] = normals[0]
+    A, B = getSpanVectorsBatch(spanNormals, np.array([0,0,1],dtype=np.float32),
+                                            np.array([0,1,0],dtype=np.float32))
+    
+    # Preallocate the vertex and normal arrays. The number of circles is
+    # known in advance (the estimate errs one circle on the safe side for
+    # an open line); the cursor k tracks how far they are filled.
+    n_cyl_est = (len(pp)-1)*3 + (11 if not lclosed else 1)
+    V = np.empty((n_cyl_est*vertex_num2, 3), dtype=np.float32)
+    SN = np.empty_like(V)
+    k = 0
+
+    # scratch buffer for scaling a circle before translating it
+    circs = np.empty((vertex_num2, 3), dtype=np.float32)
     
     # And a list for the values
     if values is None:
@@ -145,28 +247,30 @@ def lineToMesh(pp, radius, vertex_num, values=None):
     # Number of triangelized cylinder elements added to plot the 3D line
     n_cylinders = 0
     
-    # Init a and b
-    a, b = Point(0,0,1), Point(0,1,0)
-    
+    # Index into the precalculated span vectors
+    si = 0
+
     # Calculate the 3D circle coordinates of the first circle/cylinder
-    a,b = getSpanVectors(normals[0], a, b)
-    circm = getCircle(angle_cos, angle_sin, a, b)
+    circm = getCircle(angles_cs, A[si], B[si])
+    si += 1
     
     # If not a closed line, add half sphere made with 5 cylinders at line start
     if not lclosed:
-        for j in range(5,0,-1):
-            # Translate the circle on it's position on the line
-            r = (1-(j/5.0)**2)**0.5
-            circmp = float(r*radius[0])*circm + (pp[0]-(j/5.0)*bufdist*normals[0])
-            # Calc normals
-            circmn = ( pp[0].subtract(circmp) ).normalize()
-            # Store the vertex list
-            vertices.extend( circmp )
-            surfaceNormals.extend( -1*circmn )
-            if vvalues is not None:
-                for iv in range(vertex_num2):
-                    vvalues.append(values[0])
-            n_cylinders += 1
+        # Translate the circles on their position on the line, all 5 at once
+        J = np.arange(5, 0, -1) / 5.0
+        R = np.sqrt(1 - J**2)
+        circmp = ( (R[:,None,None]*radius[0]) * circm[None,:,:] +
+                   (P[0] - J[:,None,None]*bufdist*normals[0]) )
+        # Calc normals
+        circmn = _normalizeRows(P[0] - circmp)
+        # Store the vertex list
+        V[k:k+5*vertex_num2] = circmp.reshape(-1, 3)
+        SN[k:k+5*vertex_num2] = -circmn.reshape(-1, 3)
+        k += 5*vertex_num2
+        if vvalues is not None:
+            for iv in range(5*vertex_num2):
+                vvalues.append(values[0])
+        n_cylinders += 5
     
     # Loop through all line pieces
     for i in range(len(pp)-1):
@@ -176,16 +280,17 @@ def lineToMesh(pp, radius, vertex_num, values=None):
         
         # get normal and point
         normal1 = normals[i]
-        point1 = pp[i]
+        point1 = P[i]
         
         # calculate the 3D circle coordinates
-        a,b = getSpanVectors(normal1, a, b)
-        circm = getCircle(angle_cos, angle_sin, a, b)
-        
-        # Translate the circle, and store
-        circmp = float(radius[i])*circm + (point1+bufdist*normal1)
-        vertices.extend( circmp )
-        surfaceNormals.extend( circm )
+        circm = getCircle(angles_cs, A[si], B[si])
+        si += 1
+
+        # Scale and translate the circle directly into the vertex array
+        np.multiply(circm, radius[i], out=circs)
+        np.add(circs, point1+bufdist*normal1, out=V[k:k+vertex_num2])
+        SN[k:k+vertex_num2] = circm
+        k += vertex_num2
         if vvalues is not None:
             for iv in range(vertex_num2):
                 vvalues.append(values[i])
@@ -193,12 +298,13 @@ def lineToMesh(pp, radius, vertex_num, values=None):
         
         # calc second normal and line
         normal2 = normals[i+1]
-        point2 = pp[i+1]
+        point2 = P[i+1]
         
-        # Translate the circle, and store
-        circmp = float(radius[i+1])*circm + (point2-bufdist*normal1)
-        vertices.extend( circmp )
-        surfaceNormals.extend( circm )
+        # Scale and translate the circle directly into the vertex array
+        np.multiply(circm, radius[i+1], out=circs)
+        np.add(circs, point2-bufdist*normal1, out=V[k:k+vertex_num2])
+        SN[k:k+vertex_num2] = circm
+        k += vertex_num2
         if vvalues is not None:
             for iv in range(vertex_num2):
                 vvalues.append(values[i+1])
@@ -210,19 +316,19 @@ def lineToMesh(pp, radius, vertex_num, values=None):
         if not lclosed and i == len(pp)-2:
             break
         
-        # get normal and point
-        normal12 = (normal1 + normal2).normalize()
+        # get point in between the circles
         tmp = (point2+bufdist*normal2) + (point2-bufdist*normal1)
         point12 = 0.5858*point2 + 0.4142*(0.5*tmp)
-        
+
         # Calculate the 3D circle coordinates
-        a,b = getSpanVectors(normal12, a, b)
-        circm = getCircle(angle_cos, angle_sin, a, b)
+        circm = getCircle(angles_cs, A[si], B[si])
+        si += 1
         
-        # Translate the circle, and store
-        circmp = float(radius[i+1])*circm + point12
-        vertices.extend( circmp )
-        surfaceNormals.extend( circm )
+        # Scale and translate the circle directly into the vertex array
+        np.multiply(circm, radius[i+1], out=circs)
+        np.add(circs, point12, out=V[k:k+vertex_num2])
+        SN[k:k+vertex_num2] = circm
+        k += vertex_num2
         if vvalues is not None:
             for iv in range(vertex_num2):
                 vvalues.append( 0.5*(values[i]+values[i+1]) )
@@ -232,32 +338,34 @@ def lineToMesh(pp, radius, vertex_num, values=None):
     # If not a closed line, add half sphere made with 5 cylinders at line start
     # Otherwise add the starting circle to the line end.
     if not lclosed:
-        for j in range(0,6):
-            # Translate the circle on it's position on the line
-            r = (1-(j/5.0)**2)**0.5
-            circmp = float(r*radius[-1])*circm + (pp[-1]+(j/5.0)*bufdist*normals[-1])
-            # Calc normals
-            circmn = ( pp[-1].subtract(circmp) ).normalize()
-            # Store the vertex list
-            vertices.extend( circmp )
-            surfaceNormals.extend( -1*circmn )
-            if vvalues is not None:
-                for iv in range(vertex_num2):
-                    vvalues.append(values[-1])
-            n_cylinders += 1
+        # Translate the circles on their position on the line, all 6 at once
+        J = np.arange(0, 6) / 5.0
+        R = np.sqrt(1 - J**2)
+        circmp = ( (R[:,None,None]*radius[-1]) * circm[None,:,:] +
+                   (P[-1] + J[:,None,None]*bufdist*normals[-1]) )
+        # Calc normals
+        circmn = _normalizeRows(P[-1] - circmp)
+        # Store the vertex list
+        V[k:k+6*vertex_num2] = circmp.reshape(-1, 3)
+        SN[k:k+6*vertex_num2] = -circmn.reshape(-1, 3)
+        k += 6*vertex_num2
+        if vvalues is not None:
+            for iv in range(6*vertex_num2):
+                vvalues.append(values[-1])
+        n_cylinders += 6
     else:
         # get normal and point
         normal1 = normals[-1]
-        point1 = pp[-1]
+        point1 = P[-1]
         
         # calculate the 3D circle coordinates
-        a,b = getSpanVectors(normal1, a, b)
-        circm = getCircle(angle_cos, angle_sin, a, b)
-        
-        # Translate the circle, and store
-        circmp = float(radius[0])*circm + (point1+bufdist*normal1)
-        vertices.extend( circmp )
-        surfaceNormals.extend( circm )
+        circm = getCircle(angles_cs, A[si], B[si])
+
+        # Scale and translate the circle directly into the vertex array
+        np.multiply(circm, radius[0], out=circs)
+        np.add(circs, point1+bufdist*normal1, out=V[k:k+vertex_num2])
+        SN[k:k+vertex_num2] = circm
+        k += vertex_num2
         if vvalues is not None:
             for iv in range(vertex_num2):
                 vvalues.append(values[-1])
@@ -271,20 +379,16 @@ def lineToMesh(pp, radius, vertex_num, values=None):
     #lastFace = [vertex_num-1, 0, vertex_num, 2*vertex_num-1]
     firstFace = [vertex_num, vertex_num+1, 1, 0]
     lastFace = [2*vertex_num-1, vertex_num, 0, vertex_num-1]
-    
-    # define single round
-    oneRound = []
-    for i in range(vertex_num-1):
-        oneRound.extend( [val+i for val in firstFace] )
-    oneRound.extend(lastFace)
-    oneRound = np.array(oneRound, dtype=np.uint32)
-    
-    # calculate face data
-    parts = []
-    for i in range(n_cylinders-1):
-        parts.append(oneRound+i*vertex_num)
-    faces = np.concatenate(parts)
-    faces.shape = faces.shape[0]//4, 4
+
+    # define single round (the faces of one cylinder, including the one
+    # that wraps around the circle)
+    i = np.arange(vertex_num-1, dtype=np.uint32)
+    oneRound = np.column_stack([i+vertex_num, i+vertex_num+1, i+1, i])
+    oneRound = np.vstack([oneRound, np.array(lastFace, dtype=np.uint32)])
+
+    # calculate face data by offsetting the single round per cylinder
+    cyl = np.arange(n_cylinders-1, dtype=np.uint32) * vertex_num
+    faces = (oneRound[None,:,:] + cyl[:,None,None]).reshape(-1, 4)
     
     # Done!
-    return BaseMesh(vertices, faces, surfaceNormals, vvalues)
+    return BaseMesh(V[:k], faces, SN[:k], vvalues)
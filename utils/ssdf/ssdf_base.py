@@ -262,6 +262,12 @@ class Struct(object):
     def __iter__(self):
         """ Returns iterator over keys. """
         return self.__dict__.__iter__()
+
+
+    def __contains__(self, key):
+        """ Test whether a key is in the Struct object (without this,
+        'in' would iterate over all keys). """
+        return key in self.__dict__
    
     
     def __delitem__(self, key):